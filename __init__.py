@@ -1,12 +1,23 @@
-import configparser
+import hashlib
+import os
+import pickle
 import sqlite3
 import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import lru_cache, partial
+from io import BytesIO
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 from albert import *
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 md_iid = "3.0"
 md_version = "1.0"
 md_name = "Firefox Bookmarks and History"
@@ -21,31 +32,78 @@ md_credits = ["@stevenxxiu", "@sagebind"]
 firefox_bookmark_icon = Path(__file__).parent / "firefox_bookmark.svg"
 firefox_history_icon = Path(__file__).parent / "firefox_history.svg"
 
+# Icon URLs shared by all items without a favicon
+DEFAULT_BOOKMARK_ICONS = (f"file:{firefox_bookmark_icon}", "xdg:firefox")
+DEFAULT_HISTORY_ICONS = (f"file:{firefox_history_icon}", "xdg:firefox")
+
+# Only pragmas that help a reader, the databases are opened immutable
+CONNECTION_PRAGMAS = [
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",  # 64 MB
+    "PRAGMA mmap_size=268435456",  # 256 MB
+]
+
+# Albert displays icons at about this size
+FAVICON_SIZE = 32
+FAVICON_MAX_BYTES = 2048
+
+INDEX_CACHE_VERSION = 5
+
+# guid, title, url, lowercased searchable string, icon URLs
+IndexEntry = Tuple[str, Optional[str], str, str, Tuple[str, ...]]
+
 
 def get_firefox_root() -> Path:
     """Get the Firefox root directory"""
     return Path.home() / ".mozilla" / "firefox"
 
 
+def get_mtime_ns(path: Path) -> Optional[int]:
+    """Get the modification time of a file, or None if it does not exist"""
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+@lru_cache(maxsize=1)
+def read_profile_paths(profiles_ini: Path, mtime_ns: int) -> Tuple[str, ...]:
+    """Read the profile paths from profiles.ini, cached until the file changes"""
+    paths = []
+    in_profile_section = False
+
+    for line in profiles_ini.read_text().splitlines():
+        line = line.strip()
+        if line.startswith("["):
+            in_profile_section = line.startswith("[Profile")
+        elif in_profile_section:
+            key, _, value = line.partition("=")
+            if key.strip() == "Path":
+                paths.append(value.strip())
+
+    return tuple(paths)
+
+
 def get_available_profiles() -> List[str]:
     """Get list of available Firefox profiles from profiles.ini"""
     profiles = []
     firefox_root = get_firefox_root()
+    profiles_ini = firefox_root / "profiles.ini"
 
-    if not firefox_root.exists():
+    mtime_ns = get_mtime_ns(profiles_ini)
+    if mtime_ns is None:
         return profiles
 
     try:
-        config = configparser.ConfigParser()
-        config.read(firefox_root / "profiles.ini")
-
-        for section in config.sections():
-            if section.startswith("Profile") and "Path" in config[section]:
-                profile_path = firefox_root / config[section]["Path"]
-                if (profile_path / "places.sqlite").exists() and (
-                    profile_path / "favicons.sqlite"
-                ).exists():
-                    profiles.append(config[section]["Path"])
+        for path in read_profile_paths(profiles_ini, mtime_ns):
+            try:
+                with os.scandir(firefox_root / path) as it:
+                    names = {entry.name for entry in it}
+            except OSError:
+                # Missing, not a directory or unreadable
+                continue
+            if {"places.sqlite", "favicons.sqlite"} <= names:
+                profiles.append(path)
 
     except Exception as e:
         warning(f"Failed to read Firefox profiles: {str(e)}")
@@ -59,85 +117,353 @@ def get_connection(db_path: Path):
     if not db_path.exists():
         raise FileNotFoundError(f"Places database not found at {db_path}")
 
-    conn = sqlite3.connect(f"file:{db_path}?immutable=1", uri=True)
+    # mode=ro also prevents SQLite from ever creating a file in the profile
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro&immutable=1", uri=True)
     try:
+        # Best effort: tuning must never prevent reading the database
+        for pragma in CONNECTION_PRAGMAS:
+            try:
+                conn.execute(pragma)
+            except sqlite3.Error as e:
+                debug(f"Failed to apply {pragma}: {str(e)}")
         yield conn
     finally:
         conn.close()
 
 
-def get_bookmarks(places_db: Path) -> List[Tuple[str, str, str, str]]:
-    """Get all bookmarks from the places database"""
+def attach_favicons(conn: sqlite3.Connection, favicons_db: Path) -> bool:
+    """Attach the favicons database as `fav` to a places database connection"""
     try:
-        with get_connection(places_db) as conn:
-            cursor = conn.cursor()
-
-            # Query bookmarks
-            cursor.execute("""
-                SELECT bookmark.guid, bookmark.title, place.url, place.url_hash
-                FROM moz_bookmarks bookmark
-                  JOIN moz_places place ON place.id = bookmark.fk
-                WHERE bookmark.type = 1 -- 1 = bookmark
-                  AND place.hidden = 0
-                  AND place.url IS NOT NULL
-            """)
-
-            return cursor.fetchall()
-
+        conn.execute(
+            "ATTACH DATABASE ? AS fav", (f"file:{favicons_db}?mode=ro&immutable=1",)
+        )
+        return True
     except sqlite3.Error as e:
-        critical(f"Failed to read Firefox bookmarks: {str(e)}")
-        return []
+        warning(f"Failed to read favicon data: {str(e)}")
+        return False
 
 
-def get_history(places_db: Path) -> List[Tuple[str, str, str]]:
-    """Get all history items from the places database"""
+def get_bookmarks(
+    conn: sqlite3.Connection,
+) -> Iterator[Tuple[str, str, str, str, int]]:
+    """Get all bookmarks from the places database"""
+    cursor = conn.cursor()
+
+    # Query bookmarks, one per URL
+    # (SQLite takes the bare columns from the row holding MIN(guid))
+    cursor.execute("""
+        SELECT MIN(bookmark.guid), bookmark.title, place.url,
+          coalesce(bookmark.title, place.url) || ' ' || place.url,
+          place.url_hash
+        FROM moz_bookmarks bookmark
+          JOIN moz_places place ON place.id = bookmark.fk
+        WHERE bookmark.type = 1 -- 1 = bookmark
+          AND place.hidden = 0
+          AND place.url IS NOT NULL
+        GROUP BY place.url
+    """)
+
+    yield from cursor
+
+
+def get_favicons_data(
+    conn: sqlite3.Connection, url_hashes: Iterable[int]
+) -> Iterator[Tuple[int, bytes]]:
+    """Get the favicon data of the given page URL hashes from the attached database"""
+    cursor = conn.cursor()
+
+    # Upload the wanted hashes so that a single query fetches their favicons
+    cursor.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS wanted_favicons (url_hash INTEGER PRIMARY KEY)"
+    )
+    cursor.execute("DELETE FROM wanted_favicons")
+    cursor.executemany(
+        "INSERT OR IGNORE INTO wanted_favicons VALUES (?)",
+        ((url_hash,) for url_hash in url_hashes),
+    )
+
+    # Query favicons, one per page
+    cursor.execute("""
+        SELECT wanted.url_hash, icon.data
+        FROM wanted_favicons wanted
+          JOIN fav.moz_pages_w_icons page ON page.page_url_hash = wanted.url_hash
+          JOIN fav.moz_icons_to_pages icon_to_page ON icon_to_page.page_id = page.id
+          JOIN fav.moz_icons icon ON icon.id = icon_to_page.icon_id
+        WHERE icon.data IS NOT NULL
+        GROUP BY wanted.url_hash
+    """)
+
+    yield from cursor
+
+
+def get_history(
+    conn: sqlite3.Connection, limit: int
+) -> Iterator[Tuple[str, str, str, str]]:
+    """Get the most recently visited history items from the places database"""
+    cursor = conn.cursor()
+
+    # Query history excluding bookmarks
+    # (never visited places have no date and sort last)
+    cursor.execute(
+        """
+        SELECT place.guid, place.title, place.url,
+          coalesce(place.title, place.url) || ' ' || place.url
+        FROM moz_places place
+        WHERE place.hidden = 0
+          AND place.url IS NOT NULL
+          AND NOT EXISTS (
+            SELECT 1
+            FROM moz_bookmarks bookmark
+            WHERE bookmark.fk = place.id
+              AND bookmark.type = 1 -- 1 = bookmark
+          )
+        ORDER BY place.last_visit_date DESC
+        LIMIT ?
+        """,
+        # A negative limit means no limit for SQLite
+        (limit if limit > 0 else -1,),
+    )
+
+    yield from cursor
+
+
+def write_favicon(favicon_path: Path, favicon_data: bytes):
+    """Write a favicon, downscaled with Pillow when it is larger than displayed"""
+    # Write to a temporary file first so that an interrupted write is never reused
+    tmp_path = favicon_path.with_name(f".{favicon_path.name}.tmp")
+
+    resized = False
+    if Image is not None:
+        try:
+            with Image.open(BytesIO(favicon_data)) as img:
+                if (
+                    img.width > FAVICON_SIZE
+                    or img.height > FAVICON_SIZE
+                    or len(favicon_data) > FAVICON_MAX_BYTES
+                ):
+                    img.thumbnail((FAVICON_SIZE, FAVICON_SIZE), Image.LANCZOS)
+                    img.save(tmp_path, "PNG", optimize=True)
+                    resized = True
+        except Exception as e:
+            # Not an image Pillow can handle (e.g. SVG), keep it as is
+            debug(f"Failed to resize favicon {favicon_path.name}: {str(e)}")
+
+    if not resized:
+        tmp_path.write_bytes(favicon_data)
+    os.replace(tmp_path, favicon_path)
+
+
+def build_index_entries(
+    profile_location: Path, data_location: Path, index_history: bool, history_limit: int
+) -> Tuple[List[IndexEntry], bool]:
+    """Build the index entries of a profile, and whether all queries succeeded"""
+    places_db = profile_location / "places.sqlite"
+    favicons_db = profile_location / "favicons.sqlite"
+
+    # Create favicons directory if it doesn't exist
+    favicons_location = data_location / "favicons"
+    favicons_location.mkdir(exist_ok=True, parents=True)
+
+    entries = []
+    complete = True
+    kept_favicons = set()
+
+    # A single connection serves all queries
+    with get_connection(places_db) as conn:
+        try:
+            bookmarks = list(get_bookmarks(conn))
+            info(f"Found {len(bookmarks)} bookmarks")
+        except sqlite3.Error as e:
+            critical(f"Failed to read Firefox bookmarks: {str(e)}")
+            bookmarks = []
+            complete = False
+
+        favicon_icon_urls = {}
+        # A profile without favicons database simply has no favicons
+        with_favicons = bool(bookmarks) and favicons_db.exists()
+        if with_favicons and not attach_favicons(conn, favicons_db):
+            with_favicons = False
+            complete = False
+
+        if with_favicons:
+            url_hashes = (url_hash for *_, url_hash in bookmarks)
+
+            # Write favicons in the background while rows are being read
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                favicon_writes = []
+                try:
+                    for url_hash, favicon_data in get_favicons_data(conn, url_hashes):
+                        # Name favicons after their content so they are written once
+                        favicon_hash = hashlib.blake2b(
+                            favicon_data, digest_size=8
+                        ).hexdigest()
+                        favicon_path = favicons_location / f"fav_{favicon_hash}.png"
+                        if (
+                            favicon_path not in kept_favicons
+                            and not favicon_path.exists()
+                        ):
+                            favicon_writes.append(
+                                pool.submit(write_favicon, favicon_path, favicon_data)
+                            )
+                        kept_favicons.add(favicon_path)
+                        favicon_icon_urls[url_hash] = (
+                            f"file:{favicon_path}",
+                            "xdg:firefox",
+                        )
+                except sqlite3.Error as e:
+                    warning(f"Failed to read favicon data: {str(e)}")
+                    complete = False
+
+            for favicon_write in favicon_writes:
+                if favicon_write.exception():
+                    warning(
+                        f"Failed to write favicon: {str(favicon_write.exception())}"
+                    )
+
+        for guid, title, url, search_str, url_hash in bookmarks:
+            icon_urls = favicon_icon_urls.get(url_hash, DEFAULT_BOOKMARK_ICONS)
+            # Lowercased in Python, SQLite's lower() only handles ASCII
+            entries.append((guid, title, url, search_str.lower(), icon_urls))
+
+        if index_history:
+            history_count = 0
+            try:
+                for guid, title, url, search_str in get_history(conn, history_limit):
+                    history_count += 1
+                    entries.append(
+                        (guid, title, url, search_str.lower(), DEFAULT_HISTORY_ICONS)
+                    )
+                info(f"Found {history_count} history items")
+            except sqlite3.Error as e:
+                critical(f"Failed to read Firefox history: {str(e)}")
+                complete = False
+
+    # Drop favicons no longer used by any bookmark, unless a query failed
+    if complete:
+        for f in favicons_location.glob("*"):
+            if f not in kept_favicons:
+                f.unlink()
+
+    return entries, complete
+
+
+def get_index_cache_key(
+    profile_location: Path, index_history: bool, history_limit: int
+) -> tuple:
+    """Get a key identifying the state of the profile databases"""
+    # WAL files are not part of the key: immutable connections do not read them
+    return (
+        INDEX_CACHE_VERSION,
+        str(profile_location),
+        index_history,
+        # The limit does not change the index when history is not indexed
+        history_limit if index_history else None,
+        *(
+            get_mtime_ns(profile_location / name)
+            for name in ("places.sqlite", "favicons.sqlite")
+        ),
+    )
+
+
+def load_index_cache(cache_file: Path, key: tuple) -> Optional[List[IndexEntry]]:
+    """Load the cached index entries, or None if missing or stale"""
     try:
-        with get_connection(places_db) as conn:
-            cursor = conn.cursor()
+        with open(cache_file, "rb") as f:
+            cached_key, entries = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        warning(f"Failed to read index cache: {str(e)}")
+        return None
 
-            # Query history excluding bookmarks
-            cursor.execute("""
-                SELECT place.guid, place.title, place.url
-                FROM moz_places place
-                  LEFT JOIN moz_bookmarks bookmark ON place.id = bookmark.fk
-                WHERE place.hidden = 0
-                  AND place.url IS NOT NULL
-                  AND bookmark.id IS NULL
-            """)
+    if cached_key != key:
+        return None
 
-            return cursor.fetchall()
+    # Favicons may have been removed from the data location
+    icon_files = {icon_urls[0].removeprefix("file:") for *_, icon_urls in entries}
+    if not all(Path(icon_file).exists() for icon_file in icon_files):
+        return None
 
-    except sqlite3.Error as e:
-        critical(f"Failed to read Firefox history: {str(e)}")
-        return []
+    return entries
 
 
-def get_favicons_data(favicons_db: Path) -> dict[str, bytes]:
-    """Get all favicon data from the favicons database"""
+def save_index_cache(cache_file: Path, key: tuple, entries: List[IndexEntry]):
+    """Save the index entries along with the key they were built for"""
     try:
-        with get_connection(favicons_db) as conn:
-            cursor = conn.cursor()
-
-            # Query favicons
-            cursor.execute("""
-                SELECT moz_pages_w_icons.page_url_hash, moz_icons.data
-                FROM moz_icons
-                  INNER JOIN moz_icons_to_pages ON moz_icons.id = moz_icons_to_pages.icon_id
-                  INNER JOIN moz_pages_w_icons ON moz_icons_to_pages.page_id = moz_pages_w_icons.id
-            """)
-
-            return {row[0]: row[1] for row in cursor.fetchall()}
+        cache_file.parent.mkdir(exist_ok=True, parents=True)
+        with open(cache_file, "wb") as f:
+            pickle.dump((key, entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        warning(f"Failed to write index cache: {str(e)}")
+
+
+def get_index_hash(entries: List[IndexEntry]) -> bytes:
+    """Get a digest of the index entries"""
+    digest = hashlib.blake2b(digest_size=16)
+    for entry in entries:
+        digest.update("\0".join(map(str, entry)).encode())
+        digest.update(b"\1")
+    return digest.digest()
+
+
+def load_index_entries(
+    profile_location: Path, data_location: Path, index_history: bool, history_limit: int
+) -> List[IndexEntry]:
+    """Get the index entries of a profile, from the cache when it is up to date"""
+    cache_file = data_location / "index_cache.pkl"
+    cache_key = get_index_cache_key(profile_location, index_history, history_limit)
+
+    entries = load_index_cache(cache_file, cache_key)
+    if entries is None:
+        entries, complete = build_index_entries(
+            profile_location, data_location, index_history, history_limit
+        )
+        if complete:
+            save_index_cache(cache_file, cache_key, entries)
+    else:
+        info(f"Loaded {len(entries)} items from index cache")
+
+    return entries
+
+
+def update_index_items_loop(
+    plugin_ref: weakref.ref, rebuild_event: threading.Event, stop_event: threading.Event
+):
+    """Rebuild the index of the plugin each time it is requested, until it is freed"""
+    while True:
+        rebuild_event.wait()
+        rebuild_event.clear()
+        if stop_event.is_set():
+            return
 
-    except sqlite3.Error as e:
-        warning(f"Failed to read favicon data: {str(e)}")
-        return {}
+        plugin = plugin_ref()
+        if plugin is None:
+            return
+        try:
+            plugin.update_index_items_task()
+        except Exception as e:
+            critical(f"Failed to index Firefox bookmarks: {str(e)}")
+        finally:
+            # Do not keep the plugin alive while waiting for the next rebuild
+            del plugin
 
 
 class Plugin(PluginInstance, IndexQueryHandler):
     def __init__(self):
         PluginInstance.__init__(self)
         IndexQueryHandler.__init__(self)
-        self.thread = None
+        self._last_index_hash = None
+
+        # A single worker rebuilds the index, coalescing requests made meanwhile
+        self._rebuild_event = threading.Event()
+        self._stop_event = threading.Event()
+        # The worker only holds a weak reference, so that the plugin can be freed
+        self._worker = threading.Thread(
+            target=update_index_items_loop,
+            args=(weakref.ref(self), self._rebuild_event, self._stop_event),
+            daemon=True,
+        )
+        self._worker.start()
 
         # Get available profiles
         self.profiles = get_available_profiles()
@@ -158,9 +484,18 @@ class Plugin(PluginInstance, IndexQueryHandler):
             self._index_history = False
             self.writeConfig("index_history", self._index_history)
 
+        # Initialize history limit preference
+        self._history_limit = self.readConfig("history_limit", int)
+        if self._history_limit is None:
+            self._history_limit = 10000
+            self.writeConfig("history_limit", self._history_limit)
+
     def __del__(self):
-        if self.thread and self.thread.is_alive():
-            self.thread.join()
+        self._stop_event.set()
+        self._rebuild_event.set()
+        # The worker itself may drop the last reference to the plugin
+        if self._worker.is_alive() and self._worker is not threading.current_thread():
+            self._worker.join()
 
     def extensions(self):
         return [self]
@@ -188,6 +523,16 @@ class Plugin(PluginInstance, IndexQueryHandler):
         self.writeConfig("index_history", value)
         self.updateIndexItems()
 
+    @property
+    def history_limit(self):
+        return self._history_limit
+
+    @history_limit.setter
+    def history_limit(self, value):
+        self._history_limit = value
+        self.writeConfig("history_limit", value)
+        self.updateIndexItems()
+
     def configWidget(self):
         return [
             {
@@ -207,91 +552,53 @@ class Plugin(PluginInstance, IndexQueryHandler):
                     "toolTip": "Enable or disable indexing of Firefox history"
                 },
             },
+            {
+                "type": "spinbox",
+                "property": "history_limit",
+                "label": "History Limit",
+                "widget_properties": {
+                    "toolTip": "Index only the most recent history items, 0 for all",
+                    "minimum": 0,
+                    "maximum": 1000000,
+                    "singleStep": 1000,
+                },
+            },
         ]
 
     def updateIndexItems(self):
-        if self.thread and self.thread.is_alive():
-            self.thread.join()
-        self.thread = threading.Thread(target=self.update_index_items_task)
-        self.thread.start()
+        # The worker picks it up, the caller never waits for a rebuild
+        self._rebuild_event.set()
 
     def update_index_items_task(self):
-        firefox_root = get_firefox_root()
-        places_db = firefox_root / self.current_profile_path / "places.sqlite"
-        favicons_db = firefox_root / self.current_profile_path / "favicons.sqlite"
-
-        bookmarks = get_bookmarks(places_db)
-        info(f"Found {len(bookmarks)} bookmarks")
-
-        # Create favicons directory if it doesn't exist
-        favicons_location = Path(self.dataLocation()) / "favicons"
-        favicons_location.mkdir(exist_ok=True, parents=True)
-
-        # Drop existing favicons
-        for f in favicons_location.glob("*"):
-            f.unlink()
-
-        favicons = get_favicons_data(favicons_db)
+        entries = load_index_entries(
+            get_firefox_root() / self.current_profile_path,
+            Path(self.dataLocation()),
+            self._index_history,
+            self._history_limit,
+        )
+
+        # Skip notifying Albert when the index did not change
+        index_hash = get_index_hash(entries)
+        if index_hash == self._last_index_hash:
+            debug("Index is unchanged")
+            return
 
         index_items = []
-        seen_urls = set()
-
-        for guid, title, url, url_hash in bookmarks:
-            if url in seen_urls:
-                continue
-            seen_urls.add(url)
-
-            # Search and store favicons
-            favicon_data = favicons.get(url_hash)
-            if favicon_data:
-                favicon_path = favicons_location / f"favicon_{guid}.png"
-                with open(favicon_path, "wb") as f:
-                    f.write(favicon_data)
-                icon_urls = [f"file:{favicon_path}", "xdg:firefox"]
-            else:
-                icon_urls = [
-                    f"file:{firefox_bookmark_icon}",
-                    "xdg:firefox",
-                ]
-
+        for guid, title, url, search_str, icon_urls in entries:
             item = StandardItem(
                 id=guid,
                 text=title if title else url,
                 subtext=url,
                 iconUrls=icon_urls,
                 actions=[
-                    Action("open", "Open in Firefox", lambda u=url: openUrl(u)),
-                    Action("copy", "Copy URL", lambda u=url: setClipboardText(u)),
+                    Action("open", "Open in Firefox", partial(openUrl, url)),
+                    Action("copy", "Copy URL", partial(setClipboardText, url)),
                 ],
             )
 
-            # Create searchable string for the bookmark
-            index_items.append(IndexItem(item=item, string=f"{title} {url}".lower()))
-
-        if self._index_history:
-            history = get_history(places_db)
-            info(f"Found {len(history)} history items")
-            for guid, title, url in history:
-                if url in seen_urls:
-                    continue
-                seen_urls.add(url)
-                item = StandardItem(
-                    id=guid,
-                    text=title if title else url,
-                    subtext=url,
-                    iconUrls=[
-                        f"file:{firefox_history_icon}",
-                        "xdg:firefox",
-                    ],
-                    actions=[
-                        Action("open", "Open in Firefox", lambda u=url: openUrl(u)),
-                        Action("copy", "Copy URL", lambda u=url: setClipboardText(u)),
-                    ],
-                )
-
-                # Create searchable string for the history item
-                index_items.append(
-                    IndexItem(item=item, string=f"{title} {url}".lower())
-                )
+            # Searchable string is already lowercased
+            index_items.append(IndexItem(item=item, string=search_str))
 
         self.setIndexItems(index_items)
+        # Only once published, so that a failed attempt is retried
+        self._last_index_hash = index_hash